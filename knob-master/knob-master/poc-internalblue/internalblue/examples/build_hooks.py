@@ -0,0 +1,42 @@
+#!/usr/bin/env python2
+
+"""
+Assemble the hook code of bla.py (ASM_HOOKS in bla_hooks.py) once and
+store the machine code in _hooks_blob.py. bla.py writes this blob to the
+chip instead of running the assembler on every invocation.
+
+Run it again whenever ASM_HOOKS or HOOKS_LOCATION is changed:
+
+    python2 build_hooks.py
+"""
+
+from pwnlib.asm import asm
+from pwnlib.context import context
+from pwnlib.log import getLogger
+import hashlib
+import os
+
+from bla_hooks import HOOKS_LOCATION, ASM_HOOKS
+
+# bla.py imports the blob from its own directory (sys.path[0]), so the blob is
+# written next to this script and not into the current working directory
+BLOB_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_hooks_blob.py")
+
+log = getLogger('pwnlib.exploit')
+
+context.arch = "thumb"
+code = asm(ASM_HOOKS, vma=HOOKS_LOCATION, arch="thumb")
+
+f = open(BLOB_FILENAME, "w")
+f.write("# Generated by build_hooks.py from ASM_HOOKS in bla_hooks.py. Do not edit!\n\n")
+f.write("HOOKS_BLOB_LOCATION = 0x%x\n" % HOOKS_LOCATION)
+f.write("HOOKS_SOURCE_HASH = '%s'\n" % hashlib.sha1(ASM_HOOKS).hexdigest())
+f.write("HOOKS_BLOB = (\n")
+for i in range(0, len(code), 16):
+    f.write('    "%s"\n' % "".join(["\\x%02x" % ord(c) for c in code[i:i+16]]))
+f.write(")\n")
+f.close()
+
+log.info("Assembled %d bytes for 0x%x:" % (len(code), HOOKS_LOCATION))
+log.hexdump(code, begin=HOOKS_LOCATION)
+log.info("Saved in '%s'" % BLOB_FILENAME)
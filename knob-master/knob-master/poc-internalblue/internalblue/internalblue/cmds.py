@@ -26,44 +26,107 @@
 from pwn import *
 import os
 import sys
+import mmap
 import Queue
 import inspect
 import argparse
 import subprocess
-from threading import Timer
+from threading import Lock, Event, current_thread
 import textwrap
 import struct
 import time
 import select
+import re
+import atexit
+import bisect
+import binascii
+import difflib
+
+# Precompiled pcap headers (global file header and per-packet record header)
+# used by the monitor to feed Wireshark
+_PCAP_GLOBAL_HEADER = struct.Struct('@ I H H i I I I ')
+_PCAP_RECORD_HEADER = struct.Struct('@ I I I I')
+
+# Little endian dword (like u32(), but unpack_from() can read at an offset without slicing)
+_U32 = struct.Struct('<I')
+
+# Patchram slot data: 4 byte string (pack() truncates or 0-pads)
+_PATCH_DATA = struct.Struct('4s')
+
+# Printable characters (same as pwntools' isprint(): 0x20 - 0x7e)
+_PRINTABLE_RE = re.compile('[\x20-\x7e]*')
+
+# List of all Cmd subclasses and a dict which maps each keyword to its
+# Cmd subclass. Both are built on the first call of getCmdList().
+_CMD_LIST = None
+_CMD_BY_KEYWORD = None
+
+def _addCmdKeywords(cmd):
+    """ Add the keywords of a Cmd subclass to _CMD_BY_KEYWORD. Keywords which
+    are used by more than one command are mapped to None (ambiguous).
+    """
+    for keyword in cmd.keywords:
+        if keyword in _CMD_BY_KEYWORD:
+            log.warn("Multiple commands match '%s': %s" % (keyword, str([_CMD_BY_KEYWORD[keyword], cmd])))
+            _CMD_BY_KEYWORD[keyword] = None
+        else:
+            _CMD_BY_KEYWORD[keyword] = cmd
 
 def getCmdList():
     """ Returns a list of all commands which are defined in this cmds.py file.
-    This is done by searching for all subclasses of Cmd
+    This is done by searching for all subclasses of Cmd. The search is
+    only done once; commands defined elsewhere can be added with registerCmd().
     """
-    return [obj for name, obj in inspect.getmembers(sys.modules[__name__]) 
-                            if inspect.isclass(obj) and issubclass(obj, Cmd)][1:]
+    global _CMD_LIST, _CMD_BY_KEYWORD
+    if _CMD_LIST == None:
+        _CMD_LIST = [obj for name, obj in inspect.getmembers(sys.modules[__name__])
+                            if inspect.isclass(obj) and issubclass(obj, Cmd) and obj is not Cmd]
+        _CMD_BY_KEYWORD = {}
+        for cmd in _CMD_LIST:
+            _addCmdKeywords(cmd)
+    return _CMD_LIST
+
+def registerCmd(cmd):
+    """ Add a Cmd subclass which is not defined in this cmds.py file (e.g.
+    by a plugin) to the list of available commands.
+    """
+    command_list = getCmdList()
+    if cmd not in command_list:
+        command_list.append(cmd)
+        _addCmdKeywords(cmd)
 
 def findCmd(keyword):
     """ Find and return a Cmd subclass for a given keyword.
+    Returns None if no command (or more than one command) matches.
     """
-    command_list = getCmdList()
-    matching_cmds = [cmd for cmd in command_list if keyword in cmd.keywords]
-    if(len(matching_cmds) == 0):
-        return None
-    if(len(matching_cmds) > 1):
-        log.warn("Multiple commands match: " + str(matching_cmds))
-        return None
-    return matching_cmds[0]
+    getCmdList()
+    return _CMD_BY_KEYWORD.get(keyword)
+
+# In-process disassembler for ARM thumb code. Created on first use (see getCapstone()).
+_CAPSTONE = None
+
+def getCapstone():
+    """ Returns a capstone disassembler for ARM thumb code (capstone is installed
+    together with pwntools). Unlike disasm() it does not run objdump for each call.
+    """
+    global _CAPSTONE
+    if _CAPSTONE == None:
+        import capstone
+        _CAPSTONE = capstone.Cs(capstone.CS_ARCH_ARM, capstone.CS_MODE_THUMB)
+    return _CAPSTONE
 
 def auto_int(x):
     """ Convert a string (either decimal number or hex number) into an integer.
     """
     return int(x, 0)
 
+# Two-digit hex string for every byte value (used by bt_addr_to_str)
+_HEX = ["%02x" % i for i in range(256)]
+
 def bt_addr_to_str(bt_addr):
     """ Convert a Bluetooth address (6 bytes) into a human readable format.
     """
-    return ":".join([b.encode("hex") for b in bt_addr])
+    return ":".join([_HEX[ord(b)] for b in bt_addr])
 
 
 class Cmd:
@@ -74,11 +137,26 @@ class Cmd:
     """
     keywords = []
 
-    memory_image = None
+    memory_image = None     # bytearray (or mmap of the template) with the content of all sections (see initMemoryImage())
     memory_image_template_filename = "_memdump_template.bin"
 
+    # Sections sorted by start address for isAddressInSections(). Built once per section type.
+    # Key: (id of fw.SECTIONS, sectiontype)  Value: (list of start addresses, list of sections)
+    sorted_sections = {}
+
+    # Total size of the sections (used for the progress logs). Built once.
+    # Key: (id of fw.SECTIONS, include_rom, sectiontype)  Value: number of bytes (see getSectionsSize())
+    sections_size = {}
+
+    # Text editor for the --file / --edit options (read once from the environment)
+    editor = os.environ.get("EDITOR", "vim")
+
     def __init__(self, cmdline, internalblue):
         self.cmdline = cmdline
+        # Arguments for the parser (without the command keyword). Split on single
+        # spaces so that ' '.join() of a nargs='*' positional (searchmem, writemem,
+        # writeasm, ...) gives back the exact text, including runs of spaces.
+        self.argv = cmdline.split(' ')[1:]
         self.internalblue = internalblue
 
     def __str__(self):
@@ -87,6 +165,29 @@ class Cmd:
     def work(self):
         return True
 
+    def editFile(self, filename):
+        """ Open filename in the text editor. The editor is not started if stdin
+        is not a terminal (e.g. if commands are piped into the CLI by a script).
+        Returns True if the editor was started.
+        """
+        if not sys.stdin.isatty():
+            log.info("stdin is not a terminal. Not starting the editor for %s." % filename)
+            return False
+        subprocess.call([Cmd.editor, filename])
+        return True
+
+    def confirm(self, question, force=False):
+        """ Ask the user a yes/no question. Returns True without asking if force
+        is set. If stdin is not a terminal (e.g. if commands are piped into the
+        CLI by a script) nobody can answer, so False is returned without asking.
+        """
+        if force:
+            return True
+        if not sys.stdin.isatty():
+            log.warn(question + " No (stdin is not a terminal, use --force to skip this question)")
+            return False
+        return yesno(question)
+
     def abort_cmd(self):
         self.aborted = True
         if hasattr(self, 'progress_log'):
@@ -94,20 +195,30 @@ class Cmd:
 
     def getArgs(self):
         try:
-            return self.parser.parse_args(self.cmdline.split(' ')[1:])
+            return self.parser.parse_args(self.argv)
         except SystemExit:
             return None
 
+    def getSortedSections(self, sectiontype=""):
+        key = (id(self.internalblue.fw.SECTIONS), sectiontype.upper())
+        if key not in Cmd.sorted_sections:
+            sections = [section for section in self.internalblue.fw.SECTIONS
+                    if not ((sectiontype.upper() == "ROM" and not section.is_rom) or (sectiontype.upper() == "RAM" and not section.is_ram))]
+            sections.sort(key=lambda section: section.start_addr)
+            Cmd.sorted_sections[key] = ([section.start_addr for section in sections], sections)
+        return Cmd.sorted_sections[key]
+
     def isAddressInSections(self, address, length=0, sectiontype=""):
-        for section in self.internalblue.fw.SECTIONS:
-            if (sectiontype.upper() == "ROM" and not section.is_rom) or (sectiontype.upper() == "RAM" and not section.is_ram):
-                continue
+        starts, sections = self.getSortedSections(sectiontype)
 
-            if(address >= section.start_addr and address <= section.end_addr):
-                if(address + length <= section.end_addr):
-                    return True
-                else:
-                    return False
+        # Only the last section starting at or below address can contain it
+        index = bisect.bisect_right(starts, address) - 1
+        if index < 0:
+            return False
+        section = sections[index]
+        if(address <= section.end_addr):
+            if(address + length <= section.end_addr):
+                return True
         return False
 
     def readMem(self, address, length, progress_log=None, bytes_done=0, bytes_total=0):
@@ -116,35 +227,66 @@ class Cmd:
     def writeMem(self, address, data, progress_log=None, bytes_done=0, bytes_total=0):
         return self.internalblue.writeMem(address, data, progress_log, bytes_done, bytes_total)
 
+    def getSectionRanges(self, include_rom=True):
+        """ Returns a list of (start_addr, end_addr) tuples covering the sections
+        in fw.SECTIONS. Adjacent sections are merged into one range so that each
+        range can be read with a single readMem() call.
+        """
+        ranges = []
+        for section in sorted(self.internalblue.fw.SECTIONS, key=lambda s: s.start_addr):
+            if section.is_rom and not include_rom:
+                continue
+            if len(ranges) > 0 and ranges[-1][1] == section.start_addr:
+                ranges[-1] = (ranges[-1][0], section.end_addr)
+            else:
+                ranges.append((section.start_addr, section.end_addr))
+        return ranges
+
+    def getSectionsSize(self, include_rom=True, sectiontype=""):
+        """ Returns the total size of all sections in fw.SECTIONS (without the
+        ROM sections if include_rom is False). If sectiontype is "RAM" or "ROM"
+        only sections of this type are counted (like in getSortedSections()).
+        """
+        key = (id(self.internalblue.fw.SECTIONS), include_rom, sectiontype.upper())
+        if key not in Cmd.sections_size:
+            Cmd.sections_size[key] = sum([s.size() for s in self.internalblue.fw.SECTIONS
+                    if (include_rom or not s.is_rom)
+                    and not ((sectiontype.upper() == "ROM" and not s.is_rom) or (sectiontype.upper() == "RAM" and not s.is_ram))])
+        return Cmd.sections_size[key]
+
     def initMemoryImage(self):
         bytes_done = 0
         if(not os.path.exists(self.memory_image_template_filename)):
             log.info("No template found. Need to read ROM sections as well!")
-            bytes_total = sum([s.size() for s in self.internalblue.fw.SECTIONS])
+            bytes_total = self.getSectionsSize()
             self.progress_log = log.progress("Initialize internal memory image")
             dumped_sections = {}
-            for section in self.internalblue.fw.SECTIONS:
-                dumped_sections[section.start_addr] = self.readMem(section.start_addr, section.size(), self.progress_log, bytes_done, bytes_total)
-                bytes_done += section.size()
+            for start_addr, end_addr in self.getSectionRanges():
+                dumped_sections[start_addr] = self.readMem(start_addr, end_addr - start_addr, self.progress_log, bytes_done, bytes_total)
+                bytes_done += end_addr - start_addr
             self.progress_log.success("Received Data: complete")
-            Cmd.memory_image = fit(dumped_sections, filler='\x00')
+            Cmd.memory_image = bytearray(fit(dumped_sections, filler='\x00'))
             f = open(self.memory_image_template_filename, 'wb')
             f.write(Cmd.memory_image)
             f.close()
         else:
             log.info("Template found. Only read non-ROM sections!")
-            Cmd.memory_image = read(self.memory_image_template_filename)
+            # Map the template instead of reading it. ACCESS_COPY keeps the
+            # refreshed sections in memory and leaves the template file untouched.
+            f = open(self.memory_image_template_filename, 'rb')
+            Cmd.memory_image = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            f.close()
             self.refreshMemoryImage()
 
     def refreshMemoryImage(self):
         bytes_done = 0
-        bytes_total = sum([s.size() for s in self.internalblue.fw.SECTIONS if not s.is_rom])
+        bytes_total = self.getSectionsSize(include_rom=False)
         self.progress_log = log.progress("Refresh internal memory image")
-        for section in self.internalblue.fw.SECTIONS:
-            if not section.is_rom:
-                sectiondump = self.readMem(section.start_addr, section.size(), self.progress_log, bytes_done, bytes_total)
-                Cmd.memory_image = Cmd.memory_image[0:section.start_addr] + sectiondump + Cmd.memory_image[section.end_addr:]
-                bytes_done += section.size()
+        for start_addr, end_addr in self.getSectionRanges(include_rom=False):
+            sectiondump = self.readMem(start_addr, end_addr - start_addr, self.progress_log, bytes_done, bytes_total)
+            # memory_image is a bytearray or mmap, so the section is replaced in place
+            Cmd.memory_image[start_addr:end_addr] = sectiondump
+            bytes_done += end_addr - start_addr
         self.progress_log.success("Received Data: complete")
 
     def getMemoryImage(self, refresh=False):
@@ -154,6 +296,33 @@ class Cmd:
             self.refreshMemoryImage()
         return Cmd.memory_image
 
+    def dumpStreaming(self, filename, refresh=True):
+        """ Write the memory image to filename. With refresh, the non-ROM sections
+        are read from the chip and written straight into the file at their offsets
+        instead of being copied into the internal memory image first (which is
+        therefore not refreshed).
+        """
+        initialized = Cmd.memory_image == None
+        image = self.getMemoryImage()
+        f = open(filename, 'wb')
+        f.write(image)
+        if refresh and not initialized:     # a new image already contains fresh RAM
+            bytes_done = 0
+            bytes_total = self.getSectionsSize(include_rom=False)
+            self.progress_log = log.progress("Dump non-ROM sections")
+            for start_addr, end_addr in self.getSectionRanges(include_rom=False):
+                sectiondump = self.readMem(start_addr, end_addr - start_addr, self.progress_log, bytes_done, bytes_total)
+                if sectiondump == None:
+                    self.progress_log.failure("Reading 0x%x failed" % start_addr)
+                    f.close()
+                    return False
+                f.seek(start_addr)
+                f.write(sectiondump)
+                bytes_done += end_addr - start_addr
+            self.progress_log.success("Received Data: complete")
+        f.close()
+        return True
+
     def launchRam(self, address):
         return self.internalblue.launchRam(address)
 
@@ -257,16 +426,31 @@ class CmdMonitor(Cmd):
                 return None
 
         class __MonitorController:
+            # Packets are buffered and written to Wireshark once the buffer
+            # holds PCAP_BUFFER_SIZE bytes or the oldest packet is
+            # PCAP_FLUSH_INTERVAL seconds old (instead of one write+flush per packet)
+            PCAP_BUFFER_SIZE = 0x10000
+            PCAP_FLUSH_INTERVAL = 0.02
+            ETH_HEADER_CACHE_SIZE = 64  # max. number of (src, dest) pairs in eth_header_cache
+
             def __init__(self, internalblue, pcap_data_link_type):
                 self.internalblue = internalblue
                 self.running = False
                 self.wireshark_process = None
-                self.poll_timer = None
                 self.pcap_data_link_type = pcap_data_link_type
+                self.pcap_buffer = []           # pcap packets which are not yet written to Wireshark
+                self.pcap_buffer_len = 0
+                self.pcap_lock = Lock()         # the callbacks and the flush thread run in different threads
+                self.pcap_event = Event()       # set while pcap_buffer is not empty
+                self.flush_thread = None        # writes pcap_buffer to Wireshark (see _flushThreadFunc())
+                self.flush_thread_running = False
+                self.eth_header_cache = {}      # (src, dest) -> eth header of the LMP pcap packets
+                # Termination of Wireshark is detected when writing to it fails (see _flushPcap())
+                # or when the monitor is started again. Don't leave it running after exit:
+                atexit.register(self._terminateWireshark)
             
             def _spawnWireshark(self):
                 # Global Header Values
-                PCAP_GLOBAL_HEADER_FMT = '@ I H H i I I I '
                 PCAP_MAGICAL_NUMBER = 2712847316
                 PCAP_MJ_VERN_NUMBER = 2
                 PCAP_MI_VERN_NUMBER = 4
@@ -275,7 +459,7 @@ class CmdMonitor(Cmd):
                 PCAP_MAX_LENGTH_CAP = 65535
                 PCAP_DATA_LINK_TYPE = self.pcap_data_link_type
 
-                pcap_header = struct.pack('@ I H H i I I I ',
+                pcap_header = _PCAP_GLOBAL_HEADER.pack(
                         PCAP_MAGICAL_NUMBER,
                         PCAP_MJ_VERN_NUMBER,
                         PCAP_MI_VERN_NUMBER,
@@ -290,20 +474,67 @@ class CmdMonitor(Cmd):
 
                 self.wireshark_process.stdin.write(pcap_header)
 
-                self.poll_timer = Timer(3, self._pollTimer, ())
-                self.poll_timer.start()
-
-            def _pollTimer(self):
-                if self.running and self.wireshark_process != None:
-                    if self.wireshark_process.poll() == 0:
-                        # Process has ended
-                        log.debug("_pollTimer: Wireshark has terminated")
-                        self.stopMonitor()
-                        self.wireshark_process = None
-                    else:
-                        # schedule new timer
-                        self.poll_timer = Timer(3, self._pollTimer, ())
-                        self.poll_timer.start()
+            def _terminateWireshark(self):
+                if self.wireshark_process != None:
+                    log.info("Killing Wireshark process...")
+                    try:
+                        self.wireshark_process.terminate()
+                        self.wireshark_process.wait()
+                    except OSError:
+                        log.warn("Error during wireshark process termination")
+                    self.wireshark_process = None
+
+            def _writePcap(self, pcap_packet):
+                with self.pcap_lock:
+                    self.pcap_buffer.append(pcap_packet)
+                    self.pcap_buffer_len += len(pcap_packet)
+                    if self.pcap_buffer_len < self.PCAP_BUFFER_SIZE:
+                        if len(self.pcap_buffer) == 1:
+                            self.pcap_event.set()   # wake up the flush thread
+                        return
+                self._flushPcap()
+
+            def _flushThreadFunc(self):
+                """ Run-function of the flush thread. It waits until a packet is
+                buffered and writes the buffer to Wireshark PCAP_FLUSH_INTERVAL
+                seconds later. The thread lives as long as the monitor is running.
+                """
+                while self.flush_thread_running:
+                    if not self.pcap_event.wait(0.5):
+                        continue
+                    time.sleep(self.PCAP_FLUSH_INTERVAL)
+                    self._flushPcap()
+
+            def _startFlushThread(self):
+                self.flush_thread_running = True
+                self.flush_thread = context.Thread(target=self._flushThreadFunc)
+                self.flush_thread.setDaemon(True)
+                self.flush_thread.start()
+
+            def _stopFlushThread(self):
+                self.flush_thread_running = False
+                self.pcap_event.set()
+                # _flushPcap() stops the monitor from within the flush thread on broken pipe
+                if self.flush_thread != None and self.flush_thread is not current_thread():
+                    self.flush_thread.join()
+                self.flush_thread = None
+
+            def _flushPcap(self):
+                with self.pcap_lock:
+                    self.pcap_event.clear()
+                    data = ''.join(self.pcap_buffer)
+                    self.pcap_buffer = []
+                    self.pcap_buffer_len = 0
+                    if len(data) == 0 or self.wireshark_process == None:
+                        return
+                    try:
+                        self.wireshark_process.stdin.write(data)
+                        self.wireshark_process.stdin.flush()
+                        log.debug("MonitorController._flushPcap: done")
+                        return
+                    except IOError as e:
+                        log.warn("MonitorController._flushPcap: broken pipe. terminate.")
+                self.killMonitor()
 
             def startHciMonitor(self):
                 if self.running:
@@ -311,8 +542,9 @@ class CmdMonitor(Cmd):
                     return False
 
                 self.running = True
-                if self.wireshark_process == None:
+                if self.wireshark_process == None or self.wireshark_process.poll() != None:
                     self._spawnWireshark()
+                self._startFlushThread()
 
                 self.internalblue.registerHciCallback(self._callback)
                 log.info("HCI Monitor started.")
@@ -324,6 +556,8 @@ class CmdMonitor(Cmd):
                     return False
                 self.internalblue.unregisterHciCallback(self._callback)
                 self.running = False
+                self._stopFlushThread()
+                self._flushPcap()
                 log.info("HCI Monitor stopped.")
                 return True
 
@@ -333,8 +567,9 @@ class CmdMonitor(Cmd):
                     return False
 
                 self.running = True
-                if self.wireshark_process == None:
+                if self.wireshark_process == None or self.wireshark_process.poll() != None:
                     self._spawnWireshark()
+                self._startFlushThread()
 
                 self.internalblue.startLmpMonitor(self._callback)
                 log.info("LMP Monitor started.")
@@ -346,24 +581,15 @@ class CmdMonitor(Cmd):
                     return False
                 self.internalblue.stopLmpMonitor()
                 self.running = False
+                self._stopFlushThread()
+                self._flushPcap()
                 log.info("LMP Monitor stopped.")
                 return True
 
             def killMonitor(self):
                 if self.running:
                     self.stopMonitor()
-                if self.poll_timer != None:
-                    self.poll_timer.cancel()
-                    self.poll_timer = None
-                if self.wireshark_process != None:
-                    log.info("Killing Wireshark process...")
-                    try:
-                        self.wireshark_process.terminate()
-                        self.wireshark_process.wait()
-                    except OSError:
-                        log.warn("Error during wireshark process termination")
-                    self.wireshark_process = None
-                    
+                self._terminateWireshark()
 
             def getStatus(self):
                 return self.running
@@ -371,39 +597,35 @@ class CmdMonitor(Cmd):
             def hciCallback(self, record):
                 hcipkt, orig_len, inc_len, flags, drops, recvtime = record
 
-                dummy = "\x00\x00\x00"      # TODO: Figure out purpose of these fields
-                direction = p8(flags & 0x01)
-                packet = dummy + direction + hcipkt.getRaw()
+                # 3 dummy bytes (TODO: Figure out purpose of these fields) + direction
+                packet = ("\x00\x00\x00\x01" if flags & 0x01 else "\x00\x00\x00\x00") + hcipkt.getRaw()
                 length = len(packet)
                 ts_sec =  recvtime.second #+ timestamp.minute*60 + timestamp.hour*60*60 #FIXME timestamp not set
                 ts_usec = recvtime.microsecond
-                pcap_packet = struct.pack('@ I I I I', ts_sec, ts_usec, length, length) + packet
-                try:
-                    self.wireshark_process.stdin.write(pcap_packet)
-                    self.wireshark_process.stdin.flush()
-                    log.debug("HciMonitorController._callback: done")
-                except IOError as e:
-                    log.warn("HciMonitorController._callback: broken pipe. terminate.")
-                    self.killMonitor()
+                pcap_packet = _PCAP_RECORD_HEADER.pack(ts_sec, ts_usec, length, length) + packet
+                self._writePcap(pcap_packet)
 
             def lmpCallback(self, lmp_packet, sendByOwnDevice, src, dest, timestamp):
-                eth_header = dest + src + "\xff\xf0"
                 meta_data  = "\x00"*6 if sendByOwnDevice else "\x01\x00\x00\x00\x00\x00"
-                packet_header = "\x19\x00\x00" + p8(len(lmp_packet)<<3 | 7)
-
-                packet = eth_header + meta_data + packet_header + lmp_packet
-                packet += "\x00\x00" # CRC
-                length = len(packet)
+                eth_header = self.eth_header_cache.get((src, dest))
+                if eth_header == None:
+                    if len(self.eth_header_cache) >= self.ETH_HEADER_CACHE_SIZE:
+                        self.eth_header_cache.clear()
+                    eth_header = dest + src + "\xff\xf0"
+                    self.eth_header_cache[(src, dest)] = eth_header
+
+                # eth header (14) + meta data (6) + packet header (4) + lmp packet + CRC (2)
+                length = 26 + len(lmp_packet)
                 ts_sec =  timestamp.second + timestamp.minute*60 + timestamp.hour*60*60
                 ts_usec = timestamp.microsecond
-                pcap_packet = struct.pack('@ I I I I', ts_sec, ts_usec, length, length) + packet
-                try:
-                    self.wireshark_process.stdin.write(pcap_packet)
-                    self.wireshark_process.stdin.flush()
-                    log.debug("LmpMonitorController._callback: done")
-                except IOError as e:
-                    log.warn("LmpMonitorController._callback: broken pipe. terminate.")
-                    self.killMonitor()
+                # Assemble the pcap packet with a single join instead of one concatenation per part
+                pcap_packet = ''.join([_PCAP_RECORD_HEADER.pack(ts_sec, ts_usec, length, length),
+                        eth_header,
+                        meta_data,
+                        "\x19\x00\x00", p8(len(lmp_packet)<<3 | 7),      # packet header
+                        lmp_packet,
+                        "\x00\x00"])                                      # CRC
+                self._writePcap(pcap_packet)
 
 
     def work(self):
@@ -461,17 +683,17 @@ class CmdRepeat(Cmd):
             return False
 
         while True:
-            # Check for keypresses by user:
-            if select.select([sys.stdin],[],[],0.0)[0]:
-                log.info("Repeat aborted by user!")
-                return True
-
             # instanciate and run cmd
             cmd_instance = cmdclass(repcmdline, self.internalblue)
             if(not cmd_instance.work()):
                 log.warn("Command failed: " + str(cmd_instance))
                 return False
-            time.sleep(timeout*0.001)
+
+            # Wait for the next repetition. A keypress by the user ends the wait
+            # (and the repetition) immediately.
+            if select.select([sys.stdin],[],[],timeout*0.001)[0]:
+                log.info("Repeat aborted by user!")
+                return True
             
 
 class CmdDumpMem(Cmd):
@@ -487,27 +709,38 @@ class CmdDumpMem(Cmd):
     parser.add_argument("--file", "-f", default="memdump.bin",
                         help="Filename of memory dump (default: %(default)s)")
 
+    DUMP_CHUNK_SIZE = 251*16    # --ram: bytes read and written at once
+
     def work(self):
         args = self.getArgs()
         if args==None:
             return True
 
         if args.ram:
-            bytes_total = sum([s.size() for s in self.sections if s.is_ram])
+            sections = [s for s in self.internalblue.fw.SECTIONS if s.is_ram]
+            bytes_total = self.getSectionsSize(sectiontype="RAM")
             bytes_done = 0
             self.progress_log = log.progress("Downloading RAM sections...")
-            for section in filter(lambda s: s.is_ram, self.sections):
+            for section in sections:
                 filename = args.file + "_" + hex(section.start_addr)
                 if(os.path.exists(filename)):
                     if not yesno("Overwrite '%s'?" % filename):
                         log.info("Skipping section @%s" % hex(section.start_addr))
                         bytes_done += section.size()
                         continue
-                ram = self.readMem(section.start_addr, section.size(), self.progress_log, bytes_done, bytes_total)
+                # Write the section in chunks instead of keeping the whole section in memory.
+                # The chunk size is a multiple of the Read_RAM payload size (251 bytes, see readMem())
                 f = open(filename, "wb")
-                f.write(ram)
+                for address in range(section.start_addr, section.end_addr, self.DUMP_CHUNK_SIZE):
+                    length = min(self.DUMP_CHUNK_SIZE, section.end_addr - address)
+                    chunk = self.readMem(address, length, self.progress_log, bytes_done, bytes_total)
+                    if chunk == None:
+                        self.progress_log.failure("Reading 0x%x failed" % address)
+                        f.close()
+                        return False
+                    f.write(chunk)
+                    bytes_done += length
                 f.close()
-                bytes_done += section.size()
             self.progress_log.success("Done")
             return True
 
@@ -515,10 +748,8 @@ class CmdDumpMem(Cmd):
             if not yesno("Overwrite '%s'?" % os.path.abspath(args.file)):
                 return False
         
-        dump = self.getMemoryImage(refresh=not args.norefresh)
-        f = open(args.file, 'wb')
-        f.write(dump)
-        f.close()
+        if not self.dumpStreaming(args.file, refresh=not args.norefresh):
+            return False
         log.info("Memory dump saved in '%s'!" % os.path.abspath(args.file))
         return True
 
@@ -548,7 +779,7 @@ class CmdSearchMem(Cmd):
         highlight = pattern
         if args.hex:
             try:
-                pattern = pattern.decode('hex')
+                pattern = binascii.unhexlify(pattern)
                 highlight = pattern
             except TypeError as e:
                 log.warn("Search pattern cannot be converted to hexstring: " + str(e))
@@ -558,14 +789,20 @@ class CmdSearchMem(Cmd):
             highlight = [x for x in pattern if x != '\x00']
 
         memimage = self.getMemoryImage(refresh=args.refresh)
-        matches = [m.start(0) for m in re.finditer(re.escape(pattern), memimage)]
+        # The pattern is a literal byte string, so a find() loop is enough (no regex needed).
+        # Works on the bytearray as well as on the mmap'ed memory image.
+        matches = []
+        match = memimage.find(pattern)
+        while match != -1:
+            matches.append(match)
+            match = memimage.find(pattern, match + max(len(pattern), 1))
 
         hexdumplen = (len(pattern) + 16) & 0xFFFF0
         for match in matches:
             startadr = (match & 0xFFFFFFF0) - args.context
             endadr = (match+len(pattern)+16 & 0xFFFFFFF0) + args.context
             log.info("Match at 0x%08x:" % match)
-            log.hexdump(memimage[startadr:endadr], begin=startadr, highlight=highlight)
+            log.hexdump(str(memimage[startadr:endadr]), begin=startadr, highlight=highlight)
         return True
 
 class CmdHexdump(Cmd):
@@ -614,23 +851,20 @@ class CmdTelescope(Cmd):
     parser.add_argument("address", type=auto_int,
                         help="Start address of the telescope dump.")
 
-    def telescope(self, data, depth):
-        val = u32(data[0:4])
+    def telescope(self, data, depth, offset=0):
+        val = _U32.unpack_from(data, offset)[0]
         if val == 0:
             return [val, '']
         if(depth > 0 and self.isAddressInSections(val,0x20)):
-            newdata = self.readMem(val, 0x20)
+            # Pointers which were already followed are not read again (see work())
+            if val not in self.read_cache:
+                self.read_cache[val] = self.readMem(val, 0x20)
+            newdata = self.read_cache[val]
             recursive_result = self.telescope(newdata, depth-1)
             recursive_result.insert(0, val)
             return recursive_result
         else:
-            s = ''
-            for c in data:
-                if isprint(c):
-                    s += c
-                else:
-                    break
-            return [val, s]
+            return [val, _PRINTABLE_RE.match(data, offset).group(0)]
 
     def work(self):
         args = self.getArgs()
@@ -646,8 +880,10 @@ class CmdTelescope(Cmd):
         if dump == None:
             return False
 
+        # Cache for the memory read at each followed pointer (only valid during this command)
+        self.read_cache = {}
         for index in range(0, len(dump)-4, 4):
-            chain = self.telescope(dump[index:], 4)
+            chain = self.telescope(dump, 4, index)
             output = "0x%08x: " % (args.address+index)
             output += ' -> '.join(["0x%08x" % x for x in chain[:-1]])
             output += ' \"' + chain[-1] + '"'
@@ -697,11 +933,15 @@ class CmdWriteMem(Cmd):
                         help="Read data from this file instead.")
     parser.add_argument("--repeat", "-r", default=1, type=auto_int,
                         help="Number of times to repeat the data (default: %(default)s)")
+    parser.add_argument("--force", action="store_true",
+                        help="Don't ask for confirmation if the address is not inside a RAM section")
     parser.add_argument("address", type=auto_int,
                         help="Destination address") 
     parser.add_argument("data", nargs="*",
                         help="Data as string (or hexstring/integer, see --hex, --int)")
 
+    WRITE_CHUNK_SIZE = 251*16   # bytes per writeMem() call (multiple of the Write_RAM payload size)
+
     def work(self):
         args = self.getArgs()
         if args == None:
@@ -713,7 +953,7 @@ class CmdWriteMem(Cmd):
             data = ' '.join(args.data)
             if args.hex:
                 try:
-                    data = data.decode('hex')
+                    data = binascii.unhexlify(data)
                 except TypeError as e:
                     log.warn("Data string cannot be converted to hexstring: " + str(e))
                     return False
@@ -724,20 +964,36 @@ class CmdWriteMem(Cmd):
             print("Either data or --file is required!")
             return False
 
-        data = data * args.repeat
+        if len(data) == 0:
+            log.warn("No data to write!")
+            return False
+        total_length = len(data) * args.repeat
 
-        if not self.isAddressInSections(args.address, len(data), sectiontype="RAM"):
-            answer = yesno("Warning: Address 0x%08x (len=0x%x) is not inside a RAM section. Continue?" % (args.address, len(args.data)))
-            if not answer:
+        if not self.isAddressInSections(args.address, total_length, sectiontype="RAM"):
+            if not self.confirm("Warning: Address 0x%08x (len=0x%x) is not inside a RAM section. Continue?" % (args.address, total_length), args.force):
                 return False
 
-        self.progress_log = log.progress("Writing Memory")
-        if self.writeMem(args.address, data, self.progress_log, bytes_done=0, bytes_total=len(data)):
-            self.progress_log.success("Written %d bytes to 0x%08x." % (len(data), args.address))
-            return True
+        # The repeated data is written in chunks of WRITE_CHUNK_SIZE bytes instead of
+        # building the complete data in memory. Each chunk is cut out of a block,
+        # starting at the right offset into the data. Short data is repeated in the
+        # block often enough to hold any chunk. Long data is used as block directly
+        # (no copy) and a chunk wraps around its end at most once.
+        if len(data) < self.WRITE_CHUNK_SIZE:
+            block = data * (self.WRITE_CHUNK_SIZE / len(data) + 2)
         else:
-            self.progress_log.failure("Write failed!")
-            return False
+            block = data
+        self.progress_log = log.progress("Writing Memory")
+        for offset in range(0, total_length, self.WRITE_CHUNK_SIZE):
+            start = offset % len(data)
+            end = start + min(self.WRITE_CHUNK_SIZE, total_length - offset)
+            chunk = block[start:end]
+            if end > len(block):
+                chunk += block[:end - len(block)]
+            if not self.writeMem(args.address + offset, chunk, self.progress_log, bytes_done=offset, bytes_total=total_length):
+                self.progress_log.failure("Write failed!")
+                return False
+        self.progress_log.success("Written %d bytes to 0x%08x." % (total_length, args.address))
+        return True
 
 class CmdWriteAsm(Cmd):
     keywords = ['writeasm', 'asm']
@@ -749,6 +1005,8 @@ class CmdWriteAsm(Cmd):
                         help="Only pass code to the assembler but don't write to memory")
     parser.add_argument("--file", "-f",
                         help="Open file in text editor, then read assembly from this file.")
+    parser.add_argument("--force", action="store_true",
+                        help="Don't ask for confirmation if the address is not inside a RAM section")
     parser.add_argument("address", type=auto_int,
                         help="Destination address") 
     parser.add_argument("code", nargs="*",
@@ -761,14 +1019,16 @@ class CmdWriteAsm(Cmd):
 
         if args.file != None:
             if(not os.path.exists(args.file)):
+                if not sys.stdin.isatty():
+                    log.warn("File %s does not exist!" % args.file)
+                    return False
                 f = open(args.file, "w")
                 f.write("/* Write arm thumb code here.\n")
                 f.write("   Use '@' or '//' for single line comments or C-like block comments. */\n")
                 f.write("\n// 0x%08x:\n\n" % args.address)
                 f.close()
 
-            editor = os.environ.get("EDITOR", "vim")
-            subprocess.call([editor, args.file])
+            self.editFile(args.file)
 
             code = read(args.file)
         elif len(args.code) > 0:
@@ -779,7 +1039,7 @@ class CmdWriteAsm(Cmd):
             return False
 
         try:
-            data = asm(code, vma=args.address)
+            data = self.internalblue.asmCached(code, args.address)
         except PwnlibException:
             return False
 
@@ -795,8 +1055,7 @@ class CmdWriteAsm(Cmd):
             return True
 
         if not self.isAddressInSections(args.address, len(data), sectiontype="RAM"):
-            answer = yesno("Warning: Address 0x%08x (len=0x%x) is not inside a RAM section. Continue?" % (args.address, len(data)))
-            if not answer:
+            if not self.confirm("Warning: Address 0x%08x (len=0x%x) is not inside a RAM section. Continue?" % (args.address, len(data)), args.force):
                 return False
 
         self.progress_log = log.progress("Writing Memory")
@@ -820,16 +1079,35 @@ class CmdExec(Cmd):
                         help="Edit command before execution")
     parser.add_argument("--addr", "-a", type=auto_int, default=0x211800,
                         help="Destination address of the command instructions") 
+    parser.add_argument("--force", action="store_true",
+                        help="Don't ask for confirmation if the address is not inside a RAM section")
     parser.add_argument("cmd",
                         help="Name of the command to execute (corresponds to file exec_<cmd>.s)")
 
+    # Machine code of the exec_<cmd>.s files. Reassembled only if a file changes.
+    # Key: (filename, address)  Value: ((mtime, size) of the file, machine code)
+    assembled = {}
+
+    def statFile(self, filename):
+        """ Returns (mtime, size) of filename or None if it does not exist.
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
     def work(self):
         args = self.getArgs()
         if args == None:
             return True
 
         filename = "exec_%s.s" % args.cmd
-        if not os.path.exists(filename):
+        file_state = self.statFile(filename)
+        if file_state == None:
+            if not sys.stdin.isatty():
+                log.warn("File %s does not exist!" % filename)
+                return False
             f = open(filename, "w")
             f.write("/* Write arm thumb code here.\n")
             f.write("   Use '@' or '//' for single line comments or C-like block comments. */\n")
@@ -837,16 +1115,20 @@ class CmdExec(Cmd):
             f.close()
             args.edit = True
 
-        if args.edit:
-            editor = os.environ.get("EDITOR", "vim")
-            subprocess.call([editor, filename])
+        if args.edit and self.editFile(filename):
+            file_state = self.statFile(filename)
 
-        code = read(filename)
+        key = (filename, args.addr)
+        if key in CmdExec.assembled and CmdExec.assembled[key][0] == file_state:
+            data = CmdExec.assembled[key][1]
+        else:
+            code = read(filename)
 
-        try:
-            data = asm(code, vma=args.addr)
-        except PwnlibException:
-            return False
+            try:
+                data = self.internalblue.asmCached(code, args.addr)
+            except PwnlibException:
+                return False
+            CmdExec.assembled[key] = (file_state, data)
 
         if len(data)==0:
             log.info("Assembler didn't produce any machine code.")
@@ -861,20 +1143,18 @@ class CmdExec(Cmd):
             return True
 
         if not self.isAddressInSections(args.addr, len(data), sectiontype="RAM"):
-            answer = yesno("Warning: Address 0x%08x (len=0x%x) is not inside a RAM section. Continue?" % (args.addr, len(args.data)))
-            if not answer:
+            if not self.confirm("Warning: Address 0x%08x (len=0x%x) is not inside a RAM section. Continue?" % (args.addr, len(data)), args.force):
                 return False
 
-        self.progress_log = log.progress("Writing Memory")
+        # One progress log for both phases (write and launch)
+        self.progress_log = log.progress("Executing %s" % filename)
         if not self.writeMem(args.addr, data, self.progress_log, bytes_done=0, bytes_total=len(data)):
             self.progress_log.failure("Write failed!")
             return False
 
-        self.progress_log.success("Written %d bytes to 0x%08x." % (len(data), args.addr))
-
-        self.progress_log = log.progress("Launching Command")
+        self.progress_log.status("Written %d bytes to 0x%08x. Launching command..." % (len(data), args.addr))
         if self.launchRam(args.addr):
-            self.progress_log.success("launch_ram cmd was sent successfully!")
+            self.progress_log.success("Written %d bytes to 0x%08x and launch_ram cmd was sent successfully!" % (len(data), args.addr))
             return True
         else:
             self.progress_log.failure("Sending launch_ram command failed!")
@@ -900,12 +1180,14 @@ class CmdSendHciCmd(Cmd):
             log.info("cmdcode needs to be in the range of 0x0000 - 0xffff")
             return False
 
-        data = ''
-        for data_part in args.data:
-            if data_part[0:2] == "0x":
-                data += p32(auto_int(data_part))
-            else:
-                data += data_part.decode('hex')
+        # Parts starting with 0x are uint32 values (little endian), all others are hexstrings
+        try:
+            data = ''.join([_U32.pack(int(data_part, 16)) if data_part.startswith("0x")
+                            else binascii.unhexlify(data_part)
+                            for data_part in args.data])
+        except (TypeError, ValueError, struct.error) as e:
+            log.warn("Data cannot be converted: " + str(e))
+            return False
 
         self.internalblue.sendHciCommand(args.cmdcode, data)
 
@@ -929,6 +1211,8 @@ class CmdPatch(Cmd):
                         help="Patchram slot to use (0-128)") 
     parser.add_argument("--address", "-a", type=auto_int,
                         help="Destination address") 
+    parser.add_argument("--force", action="store_true",
+                        help="Don't ask for confirmation if the address is not inside a ROM section")
     parser.add_argument("data", nargs="*",
                         help="Data as string (or hexstring/integer/instruction, see --hex, --int, --asm)")
 
@@ -961,29 +1245,28 @@ class CmdPatch(Cmd):
             data = ' '.join(args.data)
             if args.hex:
                 try:
-                    data = data.decode('hex')
+                    data = binascii.unhexlify(data)
                 except TypeError as e:
                     log.warn("Data string cannot be converted to hexstring: " + str(e))
                     return False
             elif args.int:
                 data = p32(auto_int(data))
             elif args.asm:
-                data = asm(data, vma=args.address)
+                data = self.internalblue.asmCached(data, args.address)
         else:
             self.parser.print_usage()
             print("Data is required!")
             return False
 
-        if len(data) > 4:
-            log.warn("Data size is %d bytes. Trunkating to 4 byte!" % len(data))
-            data = data[0:4]
-        if len(data) < 4:
-            log.warn("Data size is %d bytes. 0-Padding to 4 byte!" % len(data))
-            data = data.ljust(4, "\x00")
+        if len(data) != 4:
+            if len(data) > 4:
+                log.warn("Data size is %d bytes. Trunkating to 4 byte!" % len(data))
+            else:
+                log.warn("Data size is %d bytes. 0-Padding to 4 byte!" % len(data))
+            data = _PATCH_DATA.pack(data)   # truncates or 0-pads to 4 byte
 
         if args.address != None and not self.isAddressInSections(args.address, len(data), sectiontype="ROM"):
-            answer = yesno("Warning: Address 0x%08x (len=0x%x) is not inside a ROM section. Continue?" % (args.address, len(data)))
-            if not answer:
+            if not self.confirm("Warning: Address 0x%08x (len=0x%x) is not inside a ROM section. Continue?" % (args.address, len(data)), args.force):
                 return False
 
         return self.internalblue.patchRom(args.address, data, args.slot)
@@ -1019,8 +1302,11 @@ class CmdSendLmp(Cmd):
             connection = None
             found_multiple_active = False
             log.info("Reading connection information to find active connection number...")
-            for i in range(self.internalblue.fw.CONNECTION_ARRAY_SIZE):
-                tmp_connection = self.internalblue.readConnectionInformation(i+1)
+            connections = self.internalblue.readAllConnectionInformation()
+            if connections == None:
+                return False
+            for i in range(len(connections)):
+                tmp_connection = connections[i]
                 if tmp_connection != None and tmp_connection["remote_address"] != "\x00"*6:
                     log.info("Found active connection with number %d (%s)." %
                             (i+1, bt_addr_to_str(tmp_connection["remote_address"])))
@@ -1050,13 +1336,13 @@ class CmdSendLmp(Cmd):
 
         data = None
         try:
-            data = args.data.decode('hex')
+            data = binascii.unhexlify(args.data)
         except TypeError as e:
             log.warn("Data string cannot be converted to hexstring: " + str(e))
             return False
 
         log.info("Sending op=%d data=%s to connection nr=%d (%s)" %
-                (args.opcode, data.encode("hex"), connection_number, remote_addr))
+                (args.opcode, binascii.hexlify(data), connection_number, remote_addr))
         return self.internalblue.sendLmpPacket(connection_number, args.opcode,
                         data, extended_op=args.extended)
 
@@ -1071,33 +1357,41 @@ class CmdInfo(Cmd):
                         help="Type of information.")
 
     def infoConnections(self):
-        for i in range(self.internalblue.fw.CONNECTION_ARRAY_SIZE):
-            connection = self.internalblue.readConnectionInformation(i+1)
+        # Always read the current table: the effective key length is negotiated
+        # over LMP before any HCI event reports it
+        connections = self.internalblue.readAllConnectionInformation(use_cache=False)
+        if connections == None:
+            return
+        for i in range(len(connections)):
+            connection = connections[i]
             if connection == None:
                 continue
 
-            log.info("### | Connection ---%02d--- ###" % i)
-            log.info("    - Number:            %d"     % connection["connection_number"])
-            log.info("    - Remote BT address: %s"     % bt_addr_to_str(connection["remote_address"]))
-            log.info("    - Remote BT name:    %08X"   % connection["remote_name_address"])
-            log.info("    - Master of Conn.:   %s"     % str(connection["master_of_connection"]))
-            log.info("    - Conn. Handle:      0x%X"   % connection["connection_handle"])
-            log.info("    - Public RAND:       %s"     % connection["public_rand"].encode('hex'))
-            #log.info("    - PIN:               %s"     % connection["pin"].encode('hex'))
-            #log.info("    - BT addr for key:   %s"     % bt_addr_to_str(connection["bt_addr_for_key"]))
-            log.info("    - Effective Key Len: %d byte (%d bit)" % (connection["effective_key_len"], 8*connection["effective_key_len"]))
-            log.info("    - Link Key:          %s"     % connection["link_key"].encode('hex'))
-            log.info("    - LMP Features:      %s"     % connection["extended_lmp_feat"].encode('hex'))
-            log.info("    - Host Supported F:  %s"     % connection["host_supported_feat"].encode('hex'))
-            log.info("    - TX Power (dBm):    %d"     % connection["tx_pwr_lvl_dBm"])
-            log.info("    - Array Index:       %s"     % connection["id"].encode('hex'))
+            # One log.info() call per connection (the lines are indented by the log prefix)
+            lines = []
+            lines.append("### | Connection ---%02d--- ###" % i)
+            lines.append("    - Number:            %d"     % connection["connection_number"])
+            lines.append("    - Remote BT address: %s"     % bt_addr_to_str(connection["remote_address"]))
+            lines.append("    - Remote BT name:    %08X"   % connection["remote_name_address"])
+            lines.append("    - Master of Conn.:   %s"     % str(connection["master_of_connection"]))
+            lines.append("    - Conn. Handle:      0x%X"   % connection["connection_handle"])
+            lines.append("    - Public RAND:       %s"     % binascii.hexlify(connection["public_rand"]))
+            #lines.append("    - PIN:               %s"     % binascii.hexlify(connection["pin"]))
+            #lines.append("    - BT addr for key:   %s"     % bt_addr_to_str(connection["bt_addr_for_key"]))
+            lines.append("    - Effective Key Len: %d byte (%d bit)" % (connection["effective_key_len"], 8*connection["effective_key_len"]))
+            lines.append("    - Link Key:          %s"     % binascii.hexlify(connection["link_key"]))
+            lines.append("    - LMP Features:      %s"     % binascii.hexlify(connection["extended_lmp_feat"]))
+            lines.append("    - Host Supported F:  %s"     % binascii.hexlify(connection["host_supported_feat"]))
+            lines.append("    - TX Power (dBm):    %d"     % connection["tx_pwr_lvl_dBm"])
+            lines.append("    - Array Index:       %s"     % binascii.hexlify(connection["id"]))
+            log.info("\n".join(lines))
         print
 
     def infoDevice(self):
-        bt_addr      = self.readMem(self.internalblue.fw.BD_ADDR, 6)[::-1]
-        bt_addr_str  = ":".join([b.encode("hex") for b in bt_addr])
+        bt_addr      = self.readMem(self.internalblue.fw.BD_ADDR, 6)
+        bt_addr_str  = bt_addr_to_str(reversed(bt_addr))   # stored in little endian
         device_name  = self.readMem(self.internalblue.fw.DEVICE_NAME, 258)
-        device_name_len = u8(device_name[0])-1
+        device_name_len = struct.unpack_from("B", device_name)[0]-1
         device_name  = device_name[2:2+device_name_len]
         adb_serial   = context.device
 
@@ -1108,30 +1402,47 @@ class CmdInfo(Cmd):
 
     def infoPatchram(self):
         table_addresses, table_values, table_slots = self.internalblue.getPatchramState()
-        log.info("### | Patchram Table ###")
-        for i in range(self.internalblue.fw.PATCHRAM_NUMBER_OF_SLOTS):
+        lines = ["### | Patchram Table ###"]   # logged with a single log.info() call
+        cs = getCapstone()
+        slot_count = self.internalblue.fw.PATCHRAM_NUMBER_OF_SLOTS
+        for i in range(slot_count):
             if table_slots[i] == 1:
-                code = disasm(table_values[i],vma=table_addresses[i],byte=False,offset=False)
-                code = code.replace("    ", " ").replace("\n", ";  ")
-                log.info("[%03d] 0x%08X: %s (%s)" % (i, table_addresses[i],
-                                                 table_values[i].encode('hex'),
-                                                 code))
+                instructions = list(cs.disasm(table_values[i], table_addresses[i]))
+                if sum([insn.size for insn in instructions]) == len(table_values[i]):
+                    code = ";  ".join([("%s %s" % (insn.mnemonic, insn.op_str)).strip() for insn in instructions])
+                else:
+                    # capstone stops at the first invalid instruction. objdump shows all of them
+                    code = disasm(table_values[i],vma=table_addresses[i],byte=False,offset=False)
+                    code = code.replace("    ", " ").replace("\n", ";  ")
+                lines.append("[%03d] 0x%08X: %s (%s)" % (i, table_addresses[i],
+                                                     binascii.hexlify(table_values[i]),
+                                                     code))
+        log.info("\n".join(lines))
+
+    # Maps the info types to the (unbound) methods which display them
+    subcommands = {"connections": infoConnections,
+                   "device":      infoDevice,
+                   "patchram":    infoPatchram}
 
     def work(self):
         args = self.getArgs()
         if args == None:
             return True
 
-        subcommands = {}
-        subcommands["connections"] = self.infoConnections
-        subcommands["device"] = self.infoDevice
-        subcommands["patchram"] = self.infoPatchram
+        info_type = args.type
+        if info_type not in CmdInfo.subcommands:
+            # Accept unique prefixes (e.g. 'info conn')
+            matches = [t for t in CmdInfo.subcommands if t.startswith(info_type)]
+            if len(matches) != 1:
+                close = difflib.get_close_matches(info_type, CmdInfo.subcommands.keys())
+                if len(close) > 0:
+                    log.warn("Unkown type: %s (did you mean %s?)" % (args.type, " or ".join(close)))
+                else:
+                    log.warn("Unkown type: %s\nKnown types: %s" % (args.type, CmdInfo.subcommands.keys()))
+                return False
+            info_type = matches[0]
 
-        if args.type in subcommands:
-            subcommands[args.type]()
-        else:
-            log.warn("Unkown type: %s\nKnown types: %s" % (args.type, subcommands.keys()))
-            return False
+        CmdInfo.subcommands[info_type](self)
         return True
 
 
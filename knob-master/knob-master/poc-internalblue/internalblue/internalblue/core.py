@@ -31,6 +31,7 @@ import socket
 import time
 import datetime
 import Queue
+import collections
 import random
 
 import hci
@@ -49,6 +50,7 @@ class InternalBlue():
         self.hciport = None     # hciport is the port number of the forwarded HCI snoop port (8872). The inject port is at hciport+1
         self.s_inject = None    # This is the TCP socket to the HCI inject port
         self.s_snoop = None     # This is the TCP socket to the HCI snoop port
+        self.reuse_forwarding = False   # True if the adb port forwarding for hciport already existed (INTERNALBLUE_HCIPORT)
 
         # If btsnooplog_filename is set, write all incomming HCI packets to a file (can be viewed in wireshark for debugging)
         if btsnooplog_filename != None:
@@ -76,6 +78,16 @@ class InternalBlue():
         self.sendThread = None                  # The thread which is responsible for the HCI inject socket
         self.lmpMonitorState = None             # A tuple which stores state information for the LMP monitor mode (see startLmpMonitor())
 
+        # The connection table read by readAllConnectionInformation() is cached for
+        # connectionInformationCacheTTL seconds as tuple (timestamp, connections).
+        # It is invalidated on HCI events which change the table (see recvThread)
+        # and when a LMP packet is sent. connectionInformationGeneration counts the
+        # invalidations, so that a table which was read while the cache was
+        # invalidated is not stored.
+        self.connectionInformationCache = None
+        self.connectionInformationCacheTTL = 2
+        self.connectionInformationGeneration = 0
+
         # The registeredHciCallbacks list holds callback functions which are being called by the
         # recvThread once a HCI Event is being received. Use registerHciCallback() for registering
         # a new callback (put it in the list) and unregisterHciCallback() for removing it again.
@@ -95,6 +107,15 @@ class InternalBlue():
                                                 # and the recvThread and sendThread are started (see connect() and shutdown())
         self.log_level = log_level
 
+        # The asmCache holds recently assembled code snippets so that a snippet
+        # which is used again (e.g. the LMP monitor hooks or the readMemAligned()
+        # snippet for the patchram tables) is not assembled again (see asmCached()).
+        # Snippets with different addresses baked in are different entries, so the
+        # cache is bounded: the least recently used entry is dropped when it is full.
+        # Key: (code, vma, arch)  Value: assembled byte string
+        self.asmCache = collections.OrderedDict()
+        self.asmCacheSize = 32
+
         self.check_binutils(fix_binutils)       # Check if ARM binutils are installed (needed for asm() and disasm())
                                                 # If fix_binutils is True, the function tries to fix the error were
                                                 # the binutils are installed but not found by pwntools (e.g. under Arch Linux)
@@ -144,6 +165,24 @@ class InternalBlue():
             log.warn("pwntools cannot find binutils for arm architecture. Disassembling will not work!")
             return False
 
+    def asmCached(self, code, vma):
+        """
+        Same as pwntools' asm(code, vma=vma), but the asmCacheSize most recently
+        used snippets are kept and not assembled again. Each asm() call runs the
+        assembler and objcopy as external processes, which is slow compared to a
+        dict lookup.
+        """
+        key = (code, vma, context.arch)
+        if key in self.asmCache:
+            # Move the entry to the end (most recently used)
+            self.asmCache[key] = self.asmCache.pop(key)
+            return self.asmCache[key]
+        machine_code = asm(code, vma=vma)
+        self.asmCache[key] = machine_code
+        if len(self.asmCache) > self.asmCacheSize:
+            self.asmCache.popitem(last=False)
+        return machine_code
+
     def _read_btsnoop_hdr(self):
         """
         Read the btsnoop header (see RFC 1761) from the snoop socket (s_snoop).
@@ -249,6 +288,12 @@ class InternalBlue():
 
             log.debug("Recv: [" + str(parsed_time) + "] " + str(record[0]))
 
+            # Events which change the connection table (or the keys stored in it):
+            # Connection_Complete, Disconnection_Complete, Encryption_Change,
+            # Link_Key_Notification and Encryption_Key_Refresh_Complete
+            if issubclass(record[0].__class__, hci.HCI_Event) and record[0].event_code in [0x03, 0x05, 0x08, 0x18, 0x30]:
+                self.invalidateConnectionInformationCache()
+
             # Put the record into all queues of registeredHciRecvQueues if their
             # filter function matches.
             for queue, filter_function in self.registeredHciRecvQueues:
@@ -346,25 +391,45 @@ class InternalBlue():
         socket in order to verify that the connection actually works correctly.
         """
 
-        # In order to support multiple parallel instances of InternalBlue
-        # (with multiple attached Android devices) we must not hard code the
-        # forwarded port numbers. Therefore we choose the port numbers
-        # randomly and hope that they are not already in use.
-        self.hciport = random.randint(60000, 65535)
-        log.debug("_setupSockets: Selected random ports snoop=%d and inject=%d" % (self.hciport, self.hciport+1))
+        # Scripts which are run over and over again (e.g. examples/bla.py) can
+        # reuse an existing port forwarding instead of setting up (and removing)
+        # a new one each time. Set it up once with
+        #   adb forward tcp:<port> tcp:8872 && adb forward tcp:<port+1> tcp:8873
+        # and export INTERNALBLUE_HCIPORT=<port>
+        if 'INTERNALBLUE_HCIPORT' in os.environ:
+            try:
+                hciport = int(os.environ['INTERNALBLUE_HCIPORT'])
+            except ValueError:
+                log.warn("INTERNALBLUE_HCIPORT (%s) is not a port number!" % os.environ['INTERNALBLUE_HCIPORT'])
+                return False
+            # The inject port hciport+1 has to be a valid port as well
+            if hciport < 1 or hciport > 65534:
+                log.warn("INTERNALBLUE_HCIPORT (%d) must be in the range 1 - 65534!" % hciport)
+                return False
+            self.hciport = hciport
+            self.reuse_forwarding = True
+            log.debug("_setupSockets: Reusing forwarded ports snoop=%d and inject=%d" % (self.hciport, self.hciport+1))
+        else:
+            # In order to support multiple parallel instances of InternalBlue
+            # (with multiple attached Android devices) we must not hard code the
+            # forwarded port numbers. Therefore we choose the port numbers
+            # randomly and hope that they are not already in use.
+            self.hciport = random.randint(60000, 65535)
+            self.reuse_forwarding = False
+            log.debug("_setupSockets: Selected random ports snoop=%d and inject=%d" % (self.hciport, self.hciport+1))
+
+            # Forward ports 8872 and 8873. Ignore log.info() outputs by the adb function.
+            saved_loglevel = context.log_level
+            context.log_level = 'warn'
+            try:
+                adb.adb(["forward", "tcp:%d"%(self.hciport),   "tcp:8872"])
+                adb.adb(["forward", "tcp:%d"%(self.hciport+1), "tcp:8873"])
+            except PwnlibException as e:
+                log.warn("Setup adb port forwarding failed: " + str(e))
+                return False
+            finally:
+                context.log_level = saved_loglevel
 
-        # Forward ports 8872 and 8873. Ignore log.info() outputs by the adb function.
-        saved_loglevel = context.log_level
-        context.log_level = 'warn'
-        try:
-            adb.adb(["forward", "tcp:%d"%(self.hciport),   "tcp:8872"])
-            adb.adb(["forward", "tcp:%d"%(self.hciport+1), "tcp:8873"])
-        except PwnlibException as e:
-            log.warn("Setup adb port forwarding failed: " + str(e))
-            return False
-        finally:
-            context.log_level = saved_loglevel
-        
         # Connect to hci injection port
         self.s_inject = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.s_inject.connect(('127.0.0.1', self.hciport+1))
@@ -381,8 +446,9 @@ class InternalBlue():
             self.s_inject.close()
             self.s_snoop.close()
             self.s_inject = self.s_snoop = None
-            adb.adb(["forward", "--remove", "tcp:%d"%(self.hciport)])
-            adb.adb(["forward", "--remove", "tcp:%d"%(self.hciport+1)])
+            if not self.reuse_forwarding:
+                adb.adb(["forward", "--remove", "tcp:%d"%(self.hciport)])
+                adb.adb(["forward", "--remove", "tcp:%d"%(self.hciport+1)])
             return False
         return True
 
@@ -398,6 +464,10 @@ class InternalBlue():
             self.s_snoop.close()
             self.s_snoop = None
 
+        # Port forwarding was set up by the user (see _setupSockets())
+        if self.reuse_forwarding:
+            return True
+
         saved_loglevel = context.log_level
         context.log_level = 'warn'
         try:
@@ -620,7 +690,7 @@ class InternalBlue():
         ### Injecting hooks ###
         # compile assembler snippet containing the hook code:
         # NOTE: len of the hooks_code is not important
-        hooks_code = asm(fw.LMP_MONITOR_INJECTED_CODE, vma=fw.LMP_MONITOR_HOOK_BASE_ADDRESS)
+        hooks_code = self.asmCached(fw.LMP_MONITOR_INJECTED_CODE, fw.LMP_MONITOR_HOOK_BASE_ADDRESS)
         # save memory content at the addresses where we place the snippet and the temp. buffer
         saved_data_hooks = self.readMem(fw.LMP_MONITOR_HOOK_BASE_ADDRESS, len(hooks_code))
         saved_data_data = ""
@@ -638,7 +708,7 @@ class InternalBlue():
         # The (original) LMP_dispatcher function needs a ROM patch for inserting a hook
         log.debug("startLmpMonitor: inserting lmp recv hook ...")
         # position of 'b hook_recv_lmp' within hook code is + 5
-        patch = asm("b 0x%x" % (fw.LMP_MONITOR_HOOK_BASE_ADDRESS + 5), vma=fw.LMP_MONITOR_LMP_HANDLER_ADDRESS)
+        patch = self.asmCached("b 0x%x" % (fw.LMP_MONITOR_HOOK_BASE_ADDRESS + 5), fw.LMP_MONITOR_LMP_HANDLER_ADDRESS)
         if not self.patchRom(fw.LMP_MONITOR_LMP_HANDLER_ADDRESS, patch):
             log.warn("startLmpMonitor: couldn't insert patch!")
             return False
@@ -890,7 +960,8 @@ class InternalBlue():
                 blocksize = 244
 
             # Customize the assembler snippet with the current read_addr and blocksize
-            code = asm(fw.READ_MEM_ALIGNED_ASM_SNIPPET % (blocksize, read_addr, blocksize/4), vma=fw.READ_MEM_ALIGNED_ASM_LOCATION)
+            # (only repeated reads of the same block, e.g. getPatchramState(), hit the cache)
+            code = self.asmCached(fw.READ_MEM_ALIGNED_ASM_SNIPPET % (blocksize, read_addr, blocksize/4), fw.READ_MEM_ALIGNED_ASM_LOCATION)
 
             # Write snippet to the RAM (TODO: maybe backup and restore content of this area?)
             self.writeMem(fw.READ_MEM_ALIGNED_ASM_LOCATION, code)
@@ -987,6 +1058,30 @@ class InternalBlue():
             
         return True
 
+    def enterDownloadMode(self):
+        """
+        Sends the vendor specific Download_Minidriver HCI command (0xfc2e).
+        While in download mode the controller suspends normal Bluetooth
+        operation and only processes memory commands such as Write_RAM.
+        launchRam(0xFFFFFFFF) leaves the download mode and restarts the
+        firmware, which closes the HCI connection (call connect() again).
+
+        Returns True on success and False on failure.
+        """
+
+        if not self.check_running():
+            return False
+
+        response = self.sendHciCommand(0xfc2e, '')
+        if (response == None):
+            log.warn("enterDownloadMode: No response to Download_Minidriver HCI command!")
+            return False
+
+        if(response[3] != '\x00'):
+            log.warn("Got error code %x in command complete event." % ord(response[3]))
+            return False
+        return True
+
     def getPatchramState(self):
         """
         Retrieves the current state of the patchram unit. The return value
@@ -1070,24 +1165,20 @@ class InternalBlue():
         table_addresses, table_values, table_slots = self.getPatchramState()
 
         # Check whether the address is already patched:
-        for i in range(fw.PATCHRAM_NUMBER_OF_SLOTS):
-            if table_addresses[i] == address:
-                slot = i
-                log.info("patchRom: Reusing slot for address 0x%x: %d" % (address,slot))
-                # Write new value to patchram value table at 0xd0000
-                self.writeMem(0xd0000 + slot*4, patch)
-                return True
+        if address in table_addresses:
+            slot = table_addresses.index(address)
+            log.info("patchRom: Reusing slot for address 0x%x: %d" % (address,slot))
+            # Write new value to patchram value table at 0xd0000
+            self.writeMem(0xd0000 + slot*4, patch)
+            return True
 
         if slot == None:
             # Find free slot:
-            for i in range(fw.PATCHRAM_NUMBER_OF_SLOTS):
-                if table_addresses[i] == None:
-                    slot = i
-                    log.info("patchRom: Choosing next free slot: %d" % slot)
-                    break
-            if slot == None:
+            if None not in table_addresses:
                 log.warn("patchRom: All slots are in use!")
                 return False
+            slot = table_addresses.index(None)
+            log.info("patchRom: Choosing next free slot: %d" % slot)
         else:
             if table_values[slot] == 1:
                 log.warn("patchRom: Slot %d is already in use. Overwriting..." % slot)
@@ -1106,6 +1197,93 @@ class InternalBlue():
         self.writeMem(fw.PATCHRAM_ENABLED_BITMAP_ADDRESS + target_dword*4, slot_dword)
         return True
 
+    def patchRomBatch(self, patches, patchram_state=None):
+        """
+        Apply multiple ROM patches at once (see also patchRom()).
+
+        patches:        A list of (address, patch) tuples. Each patch has to be a
+                        byte string of length 4. Addresses which are not 4-byte aligned
+                        are splitted into two slots (like patchRom() does).
+        patchram_state: The return value of getPatchramState() if it was already
+                        read by the caller (e.g. before entering download mode).
+
+        In contrast to calling patchRom() for every patch, the patchram state is
+        only read once and the slots are allocated together. The value table,
+        target table and enable bitmap are then written with one writeMem() call
+        per range of consecutive slots instead of three calls per patch.
+
+        Returns True on success and False on failure.
+        """
+
+        # Check if constants are defined in fw.py
+        for const in ['PATCHRAM_TARGET_TABLE_ADDRESS', 'PATCHRAM_ENABLED_BITMAP_ADDRESS',
+                      'PATCHRAM_VALUE_TABLE_ADDRESS', 'PATCHRAM_NUMBER_OF_SLOTS']:
+            if const not in dir(fw):
+                log.warn("patchRomBatch: '%s' not in fw.py. FEATURE NOT SUPPORTED!" % const)
+                return False
+
+        # Split unaligned patches into aligned dword patches
+        dword_patches = []
+        for address, patch in patches:
+            if len(patch) != 4:
+                log.warn("patchRomBatch: patch (%s) must be a 32-bit dword!" % patch)
+                return False
+            alignment = address % 4
+            if alignment != 0:
+                log.debug("patchRomBatch: Address 0x%x is not 4-byte aligned!" % address)
+                orig = self.readMem(address - alignment, 8)
+                if orig == None:
+                    return False
+                dword_patches.append((address - alignment, orig[:alignment] + patch[:4-alignment]))
+                dword_patches.append((address - alignment + 4, patch[4-alignment:] + orig[alignment+4:]))
+            else:
+                dword_patches.append((address, patch))
+
+        if patchram_state == None:
+            patchram_state = self.getPatchramState()
+        table_addresses, table_values, table_slots = patchram_state
+
+        # Assign a slot to each patch (reuse the slot if the address is already patched)
+        slot_patches = {}
+        for address, patch in dword_patches:
+            if address in table_addresses:
+                slot = table_addresses.index(address)
+                log.info("patchRomBatch: Reusing slot for address 0x%x: %d" % (address, slot))
+            elif None in table_addresses:
+                slot = table_addresses.index(None)
+                log.info("patchRomBatch: Choosing next free slot: %d" % slot)
+            else:
+                log.warn("patchRomBatch: All slots are in use!")
+                return False
+            table_addresses[slot] = address
+            slot_patches[slot] = (address, patch)
+
+        # Write value and target tables for each range of consecutive slots
+        slots = sorted(slot_patches.keys())
+        while len(slots) > 0:
+            first = slots[0]
+            count = 1
+            while count < len(slots) and slots[count] == first + count:
+                count += 1
+            run = [slot_patches[slot] for slot in slots[:count]]
+            slots = slots[count:]
+
+            values  = ''.join([patch for address, patch in run])
+            targets = ''.join([p32(address >> 2) for address, patch in run])
+            if not self.writeMem(fw.PATCHRAM_VALUE_TABLE_ADDRESS + first*4, values):
+                return False
+            if not self.writeMem(fw.PATCHRAM_TARGET_TABLE_ADDRESS + first*4, targets):
+                return False
+
+        # Enable the patchram slots (one write per affected bitfield dword)
+        for slot in slot_patches:
+            table_slots[slot] = 1
+        for target_dword in sorted(set([int(slot / 32) for slot in slot_patches])):
+            slot_dword = unbits(table_slots[target_dword*32:(target_dword+1)*32][::-1])[::-1]
+            if not self.writeMem(fw.PATCHRAM_ENABLED_BITMAP_ADDRESS + target_dword*4, slot_dword):
+                return False
+        return True
+
     def disableRomPatch(self, address, slot=None):
         """
         Disable a patchram slot (see also patchRom()). The slot can either be
@@ -1178,6 +1356,64 @@ class InternalBlue():
                             fw.CONNECTION_STRUCT_LENGTH*(conn_number-1),
                             fw.CONNECTION_STRUCT_LENGTH)
 
+        return self._parseConnectionInformation(connection)
+
+    def readAllConnectionInformation(self, use_cache=True):
+        """
+        Reads and parses all connection structs (see readConnectionInformation()).
+        The whole connection table is read with a single readMem() call instead
+        of one call per connection, which needs fewer Read_RAM HCI commands.
+
+        The return value is a list with CONNECTION_ARRAY_SIZE entries. The entry
+        at index i belongs to connection number i+1 and is either a dictionary
+        (see readConnectionInformation()) or None if the connection struct is empty.
+        Returns None on failure.
+
+        If use_cache is True, the result of a previous call which is not older
+        than connectionInformationCacheTTL seconds is returned (see __init__()).
+        """
+
+        # Check if constants are defined in fw.py
+        for const in ['CONNECTION_ARRAY_SIZE', 'CONNECTION_ARRAY_ADDRESS', 'CONNECTION_STRUCT_LENGTH']:
+            if const not in dir(fw):
+                log.warn("readAllConnectionInformation: '%s' not in fw.py. FEATURE NOT SUPPORTED!" % const)
+                return None
+
+        cache = self.connectionInformationCache
+        if use_cache and cache != None and time.time() - cache[0] < self.connectionInformationCacheTTL:
+            log.debug("readAllConnectionInformation: using cached connection table")
+            return cache[1]
+
+        struct_length   = fw.CONNECTION_STRUCT_LENGTH
+        array_size      = fw.CONNECTION_ARRAY_SIZE
+        parse           = self._parseConnectionInformation
+
+        timestamp = time.time()
+        generation = self.connectionInformationGeneration
+        table = self.readMem(fw.CONNECTION_ARRAY_ADDRESS, struct_length*array_size)
+        if table == None:
+            return None
+
+        connections = [parse(table[offset:offset+struct_length])
+                    for offset in range(0, struct_length*array_size, struct_length)]
+        # Don't cache the table if it was invalidated during the read
+        if generation == self.connectionInformationGeneration:
+            self.connectionInformationCache = (timestamp, connections)
+        return connections
+
+    def invalidateConnectionInformationCache(self):
+        """
+        Drop the cached connection table (see readAllConnectionInformation()).
+        """
+        self.connectionInformationGeneration += 1
+        self.connectionInformationCache = None
+
+    def _parseConnectionInformation(self, connection):
+        """
+        Parse a connection struct (see readConnectionInformation()).
+        Returns None if the connection struct is empty.
+        """
+
         if connection == b'\x00'*fw.CONNECTION_STRUCT_LENGTH:
             return None
 
@@ -1236,6 +1472,9 @@ class InternalBlue():
             log.warn("sendLmpPacket: connection number out of bounds: %d" % conn_nr)
             return False
 
+        # The packet may change the connection state (see readAllConnectionInformation())
+        self.invalidateConnectionInformationCache()
+
         # Build the LMP packet
         # (The TID bit will later be set in the assembler code)
         # NOTE: extended payloads are supported
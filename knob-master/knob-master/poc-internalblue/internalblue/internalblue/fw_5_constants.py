@@ -136,10 +136,8 @@ READ_MEM_ALIGNED_ASM_SNIPPET = """
         ldr  r1, =0x%x  // readMemAligned() injects the read_address here. r1 will be used as src pointer in the loop
         mov  r2, %d     // readMemAligned() injects the number of dwords to read here. r2 will be the loop counter
     loop:
-        ldr  r3, [r1]   // read 4 bytes from the read_address
-        str  r3, [r0]   // store them inside the HCI buffer
-        add  r0, 4      // advance the buffer pointer
-        add  r1, 4      // advance the read_address
+        ldr  r3, [r1], 4  // read 4 bytes from the read_address and advance it
+        str  r3, [r0], 4  // store them inside the HCI buffer and advance the buffer pointer
         subs r2, 1      // decrement the loop variable
         bne  loop       // branch if r2 is not zero yet
 